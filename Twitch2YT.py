@@ -1,4 +1,4 @@
-import os, json, time, logging, threading, subprocess, sys, glob
+import os, json, time, logging, threading, subprocess, sys, glob, functools, re, signal, random
 import streamlink
 from urllib.parse import urlparse
 import imageio_ffmpeg as iio_ffmpeg
@@ -6,14 +6,19 @@ import imageio_ffmpeg as iio_ffmpeg
 # --- Config ---
 CONFIG_FILE = "config.json"
 FFMPEG_MAX_RUNTIME = 10.5 * 60 * 60
+STREAM_POLL_INTERVAL = 60
+# An FFmpeg that dies sooner than this after starting counts as a failed start
+FFMPEG_MIN_UPTIME = 30
 cpu_cores = os.cpu_count() or 1
 try:
     import psutil
     total_ram_gb = psutil.virtual_memory().total / (1024**3)
-except:
+except Exception:
     total_ram_gb = 8
 low_cpu = cpu_cores <= 2
 low_ram = total_ram_gb <= 4
+# Leave one core free for Python/streamlink on the input side
+ffmpeg_threads = max(1, cpu_cores - 1)
 
 # --- Logging ---
 logging.basicConfig(
@@ -32,6 +37,7 @@ def find_ffmpeg_windows():
         return search_paths[0]
     return None
 
+@functools.lru_cache(maxsize=1)
 def get_ffmpeg_path():
     ffmpeg_path = None
     if getattr(sys, "frozen", False):
@@ -50,156 +56,228 @@ def get_ffmpeg_path():
 
 def detect_gpu_encoder():
     try:
-        out = subprocess.run([get_ffmpeg_path(), "-encoders"], capture_output=True, text=True, check=True).stdout.lower()
-        if "h264_nvenc" in out: return "h264_nvenc"
-        if "h264_amf" in out: return "h264_amf"
-        if "h264_qsv" in out: return "h264_qsv"
+        out = subprocess.run([FFMPEG_PATH, "-encoders"], capture_output=True, text=True, check=True).stdout
+        # Encoder rows look like " V....D h264_nvenc  NVIDIA NVENC H.264 encoder"
+        names = {parts[1] for line in out.splitlines() if line.startswith((" V", " A")) and len(parts := line.split()) > 1}
+        for enc in ("h264_nvenc", "h264_amf", "h264_qsv"):
+            if enc in names: return enc
     except subprocess.CalledProcessError as e:
-        logger.warning(f"GPU detection failed: {e}")
+        logger.warning("GPU detection failed: %s", e)
     except FileNotFoundError:
         logger.warning("FFmpeg executable not found for GPU detection")
     return None
 
-gpu_encoder = detect_gpu_encoder()
-if not gpu_encoder:
+# Resolved once at import; both are reused on every FFmpeg (re)start
+FFMPEG_PATH = get_ffmpeg_path()
+GPU_ENCODER = detect_gpu_encoder()
+if not GPU_ENCODER:
     logger.info("GPU encoding unavailable, will fall back to CPU if needed.")
 
 # --- Config Loader ---
 def load_config():
-    while True:
-        if not os.path.exists(CONFIG_FILE):
-            cfg = {}
-            twitch = input("Twitch username or URL: ").strip()
-            if twitch.startswith("http"):
-                try:
-                    p = urlparse(twitch)
-                    if p.netloc not in ("twitch.tv", "www.twitch.tv"):
-                        raise ValueError()
-                    u = p.path.strip("/")
-                    cfg["username"] = u or None
-                except:
-                    print("Invalid Twitch URL")
-                    continue
-            else:
-                cfg["username"] = twitch if twitch else None
-            cfg["youtube_key"] = input("YouTube stream key: ").strip()
-            with open(CONFIG_FILE, "w") as f:
-                json.dump(cfg, f)
-            print(f"Config saved to {CONFIG_FILE}")
+    try:
+        with open(CONFIG_FILE, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    cfg = {}
+    while "username" not in cfg:
+        twitch = input("Twitch username or URL: ").strip()
+        if twitch.startswith("http"):
+            try:
+                p = urlparse(twitch)
+                if p.netloc not in ("twitch.tv", "www.twitch.tv"):
+                    raise ValueError()
+                u = p.path.strip("/")
+                cfg["username"] = u or None
+            except ValueError:
+                print("Invalid Twitch URL")
         else:
-            with open(CONFIG_FILE, "r") as f:
-                cfg = json.load(f)
-        return cfg
+            cfg["username"] = twitch if twitch else None
+    cfg["youtube_key"] = input("YouTube stream key: ").strip()
+    with open(CONFIG_FILE, "w") as f:
+        json.dump(cfg, f)
+    print(f"Config saved to {CONFIG_FILE}")
+    return cfg
 
 config = load_config()
 TWITCH_USER = config["username"]
 YOUTUBE_KEY = config["youtube_key"]
 YOUTUBE_RTMP = f"rtmps://a.rtmps.youtube.com/live2/{YOUTUBE_KEY}"
+TWITCH_URL = f"https://www.twitch.tv/{TWITCH_USER}"
+WAITING_MSG = f"Waiting for Twitch stream: {TWITCH_URL}"
 
 # --- Stream Helpers ---
+# One session for the whole run so HTTP connections to Twitch stay alive between polls
+SL = streamlink.Streamlink()
+SL.set_option("hls-live-edge", 2)
+
 def get_available_streams():
     try:
-        return {n: s for n, s in streamlink.streams(f"https://www.twitch.tv/{TWITCH_USER}").items() if "audio" not in n.lower()}
+        return {n: s for n, s in SL.streams(TWITCH_URL).items() if "audio" not in n.lower()}
     except Exception as e:
-        logger.warning(f"Failed to get streams: {e}")
+        logger.warning("Failed to get streams: %s", e)
         return {}
 
+_Q_RE = re.compile(r"\d+")
+
 def pick_best_stream(streams):
+    if not streams:
+        return None, None
     if "best" in streams:
         return "best", streams["best"]
-    qs = [q for q in streams if any(c.isdigit() for c in q)]
-    if qs:
-        best_q = sorted(qs, reverse=True)[0]
-        return best_q, streams[best_q]
-    return next(iter(streams.items()))
-
-# --- Process Tracking ---
-active_processes = {}
-process_lock = threading.Lock()
+    # Compare (height, fps, ...) so "720p60" beats "720p30"; non-numeric names rank last
+    best_q = max(streams, key=lambda q: tuple(map(int, _Q_RE.findall(q))) or (-1,))
+    return best_q, streams[best_q]
 
 # --- FFmpeg Relay ---
-def start_ffmpeg(stream, quality, retries=3):
-    global active_processes
+# Twitch HLS audio is already AAC, so it is copied unless YouTube refuses it
+AUDIO_COPY_FLAGS = ["-c:a", "copy"]
+AUDIO_AAC_FLAGS = ["-c:a", "aac", "-ar", "44100", "-b:a", "128k", "-ac", "2"]
+AUDIO_COPY_PROBE = 5
+# Whether YouTube accepts copied audio: None until the first start of the session probes it
+audio_copy_ok = None
+
+# Opened once and shared by every FFmpeg child. With close_fds=False CPython can use
+# posix_spawn instead of fork; Python fds are non-inheritable, so nothing else leaks
+_DEVNULL = open(os.devnull, "wb")
 
+def backoff_delay(attempt, cap=30):
+    # Exponential backoff with jitter so repeated failures spread out
+    return min(cap, (2 ** attempt) + random.uniform(0, 1))
+
+def exited_early(proc, timeout=AUDIO_COPY_PROBE):
+    try:
+        proc.wait(timeout=timeout)
+        return True
+    except subprocess.TimeoutExpired:
+        return False
+
+def stop_ffmpeg(proc):
+    # SIGTERM → SIGINT (FFmpeg's fast quit, flushes the muxer) → SIGKILL
+    proc.terminate()
     try:
-        # Pre-fetch Twitch HLS data to ensure FFmpeg gets valid video parameters
-        logger.info("Pre-fetching Twitch HLS segments to ensure valid video parameters...")
-        prewarm_ok = False
+        proc.wait(timeout=2)
+        return
+    except subprocess.TimeoutExpired:
+        pass
+    if os.name != "nt":
+        proc.send_signal(signal.SIGINT)
         try:
-            fd = stream.open()
-            chunk_count = 0
-            for _ in range(3):
-                data = fd.read(1024 * 512)
-                if not data:
-                    break
-                chunk_count += 1
-                time.sleep(0.3)
-            fd.close()
-            if chunk_count > 0:
-                prewarm_ok = True
-                logger.info(f"HLS manifest pre-fetched successfully ({chunk_count} chunks).")
-        except Exception as e:
-            logger.warning(f"Failed to prefetch HLS data (continuing anyway): {e}")
+            proc.wait(timeout=1)
+            return
+        except subprocess.TimeoutExpired:
+            pass
+    proc.kill()
+    proc.wait()
 
+def resolve_stream_url(stream):
+    try:
         url = stream.to_url()
-        if not url or not url.startswith("http"):
-            logger.error(f"Invalid stream URL: {url}")
-            return None
-
     except Exception as e:
-        logger.error(f"Cannot get stream URL: {e}")
+        logger.error("Cannot get stream URL: %s", e)
         return None
+    if not url or not url.startswith("http"):
+        logger.error("Invalid stream URL: %s", url)
+        return None
+    return url
 
-    ffmpeg_path = get_ffmpeg_path()
+def start_ffmpeg(stream, quality, retries=3):
+    global audio_copy_ok
+
+    url = resolve_stream_url(stream)
+    if not url:
+        return None
+
+    # Pre-fetch Twitch HLS data to ensure FFmpeg gets valid video parameters
+    logger.info("Pre-fetching Twitch HLS segments to ensure valid video parameters...")
+    prewarm_ok = False
+    try:
+        fd = stream.open()
+        chunk_count = 0
+        for _ in range(3):
+            data = fd.read(1024 * 512)
+            if not data:
+                break
+            chunk_count += 1
+            time.sleep(0.3)
+        fd.close()
+        if chunk_count > 0:
+            prewarm_ok = True
+            logger.info("HLS manifest pre-fetched successfully (%d chunks).", chunk_count)
+    except Exception as e:
+        logger.warning("Failed to prefetch HLS data (continuing anyway): %s", e)
+
+    # Only the codec section changes between attempts, so the rest is built once
+    input_args = [
+        FFMPEG_PATH, "-threads", str(ffmpeg_threads), "-nostats", "-loglevel", "warning",
+        "-fflags", "+nobuffer",
+        "-i", url,
+        "-filter_threads", "1", "-filter_complex_threads", "1",
+    ]
+    output_args = [
+        *(["-bufsize", "2M", "-fflags", "+genpts"] if low_ram else []),
+        # Batch packets into fewer socket writes on the RTMPS uplink
+        "-flush_packets", "0", "-max_muxing_queue_size", "1024",
+        "-f", "flv", "-flvflags", "no_duration_filesize", YOUTUBE_RTMP,
+    ]
+    adjustments = f" | CPU={cpu_cores} RAM={total_ram_gb:.1f}GB" if low_cpu or low_ram else ""
 
     # Try with encoder priority: COPY → GPU → CPU
-    for attempt in range(1, retries + 1):
+    attempt = 1
+    audio_flags = AUDIO_AAC_FLAGS if audio_copy_ok is False else AUDIO_COPY_FLAGS
+    while attempt <= retries:
         if attempt == 1:
             encoder_used = "copy"
             codec_flags = ["-c:v", "copy"]
-        elif attempt == 2 and gpu_encoder:
-            encoder_used = gpu_encoder
-            codec_flags = ["-c:v", gpu_encoder, "-preset", "p1"]
+        elif attempt == 2 and GPU_ENCODER:
+            encoder_used = GPU_ENCODER
+            codec_flags = ["-c:v", GPU_ENCODER, "-preset", "p1"]
         else:
             encoder_used = "libx264"
             codec_flags = ["-c:v", "libx264", "-preset", "veryfast"]
 
+        # Stream copy needs a single output thread; real encoders get the same pool as the input
+        output_threads = "1" if encoder_used == "copy" else str(ffmpeg_threads)
+
         cmd = [
-            ffmpeg_path, "-nostats", "-loglevel", "warning", "-re",
-            "-i", url,
+            *input_args,
+            "-threads", output_threads,
             *codec_flags,
             "-pix_fmt", "yuv420p",
-            "-c:a", "aac", "-ar", "44100", "-b:a", "128k", "-ac", "2",
-            "-bufsize", "2M", "-fflags", "+genpts",
-            "-f", "flv", YOUTUBE_RTMP,
+            *audio_flags,
+            *output_args,
         ]
 
-        adjustments = ""
-        if low_cpu or low_ram:
-            cmd += ["-threads", str(max(1, cpu_cores))]
-            adjustments = f" | CPU={cpu_cores} RAM={total_ram_gb:.1f}GB"
-
         try:
-            proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
-
-            with process_lock:
-                old_proc = active_processes.get(TWITCH_USER)
-                if old_proc and old_proc != proc:
-                    old_proc.terminate()
-                    try:
-                        old_proc.wait(timeout=10)
-                    except subprocess.TimeoutExpired:
-                        old_proc.kill()
-                active_processes[TWITCH_USER] = proc
+            proc = subprocess.Popen(cmd, stdout=_DEVNULL, stderr=subprocess.PIPE, text=True, close_fds=False)
 
-            logger.info(f"FFmpeg PID {proc.pid} started | Quality: {quality} | Encoder: {encoder_used}{adjustments}")
+            audio_used = "copy" if audio_flags is AUDIO_COPY_FLAGS else "aac"
+            logger.info("FFmpeg PID %d started | Quality: %s | Encoder: %s | Audio: %s%s", proc.pid, quality, encoder_used, audio_used, adjustments)
 
             threading.Thread(target=monitor_ffmpeg_errors, args=(proc,), daemon=True).start()
+
+            if audio_copy_ok is None:
+                if not exited_early(proc):
+                    audio_copy_ok = audio_flags is AUDIO_COPY_FLAGS
+                    if not audio_copy_ok:
+                        logger.info("Audio copy refused, using AAC re-encode for this session")
+                elif audio_flags is AUDIO_COPY_FLAGS:
+                    logger.warning("FFmpeg exited with code %s using audio copy, retrying with AAC re-encode", proc.returncode)
+                    audio_flags = AUDIO_AAC_FLAGS
+                    continue
+                else:
+                    # Both audio modes died, so the cause is elsewhere (key, network, input)
+                    logger.warning("FFmpeg also exited with code %s using AAC re-encode", proc.returncode)
+                    return None
             return proc
 
         except Exception as e:
-            logger.warning(f"FFmpeg attempt {attempt} ({encoder_used}) failed: {e}")
-            time.sleep(3)
+            logger.warning("FFmpeg attempt %d (%s) failed: %s", attempt, encoder_used, e)
+            if attempt < retries:
+                # After the last attempt Relay.back_off does the waiting
+                time.sleep(backoff_delay(attempt))
+            attempt += 1
 
     logger.error("All FFmpeg attempts failed.")
     return None
@@ -212,9 +290,9 @@ def monitor_ffmpeg_errors(proc):
         if not line:
             continue
         if "error" in line.lower() or "fail" in line.lower():
-            logger.error(f"FFmpeg: {line}")
+            logger.error("FFmpeg: %s", line)
         elif "warning" in line.lower():
-            logger.warning(f"FFmpeg: {line}")
+            logger.warning("FFmpeg: %s", line)
     proc.stderr.close()
 
 # --- Relay Class ---
@@ -227,69 +305,110 @@ class Relay:
         self.stream_obj = None
         self.last_stream_status = None
         self.last_upgrade_logged = False
+        self.exit_event = threading.Event()
+        self.start_failures = 0
 
-    def wait_for_stream(self):
+    def wait_for_stream(self, streams=None):
+        # `streams` is a listing the caller just fetched; reuse it instead of asking Twitch again
         while True:
-            streams = get_available_streams()
+            if streams is None:
+                streams = get_available_streams()
             if streams:
                 quality, stream = pick_best_stream(streams)
                 if stream:
                     if self.last_stream_status != "online":
-                        logger.info(f"Twitch stream online | Quality: {quality}")
+                        logger.info("Twitch stream online: %s | Quality: %s", TWITCH_URL, quality)
                         self.last_stream_status = "online"
                     return quality, stream
             if self.last_stream_status != "offline":
-                logger.info("Waiting for Twitch stream...")
+                logger.info(WAITING_MSG)
                 self.last_stream_status = "offline"
             time.sleep(15)
+            streams = None
 
     def start_relay(self):
+        streams = None
         while True:
-            quality, stream = self.wait_for_stream()
+            quality, stream = self.wait_for_stream(streams)
+            streams = None
             with self.lock:
                 self.start_new_ffmpeg(stream, quality)
             while True:
-                time.sleep(30)
+                # Wakes immediately when FFmpeg exits, otherwise every poll interval
+                exited = self.exit_event.wait(timeout=STREAM_POLL_INTERVAL)
+                if exited:
+                    # Cleared before polling so an exit racing this check still wakes the next wait
+                    self.exit_event.clear()
                 with self.lock:
-                    if not self.current_ffmpeg or self.current_ffmpeg.poll() is not None:
-                        logger.info("FFmpeg ended unexpectedly, restarting...")
+                    if not self.current_ffmpeg:
+                        # Last start failed and has already backed off
+                        break
+                    if self.current_ffmpeg.poll() is not None:
+                        uptime = time.time() - self.start_time
+                        if uptime < FFMPEG_MIN_UPTIME:
+                            self.back_off("FFmpeg exited after %.0fs", uptime)
+                        else:
+                            self.start_failures = 0
+                            logger.info("FFmpeg ended unexpectedly, restarting...")
                         break
                     elapsed = time.time() - self.start_time
+                    if elapsed >= FFMPEG_MIN_UPTIME:
+                        # Only a process that stayed up counts as a recovery
+                        self.start_failures = 0
+                    if exited:
+                        # Stale wake-up from a replaced process
+                        continue
                     if elapsed > FFMPEG_MAX_RUNTIME:
+                        # Restart from a fresh stream listing: reusing the old stream object
+                        # would hand FFmpeg the same playlist URL and its expired token
                         logger.info("Max runtime reached, restarting FFmpeg...")
-                        self.start_new_ffmpeg(stream, quality)
                         break
-                    streams = get_available_streams()
-                    if "best" in streams and self.current_quality != "best":
+                    latest = get_available_streams()
+                    if "best" in latest and self.current_quality != "best":
                         if not self.last_upgrade_logged:
                             logger.info("Higher quality available, upgrading...")
                             self.last_upgrade_logged = True
-                        self.start_new_ffmpeg(streams["best"], "best")
+                        # The outer loop picks "best" from this listing and starts it once
+                        streams = latest
                         break
                     else:
                         self.last_upgrade_logged = False
-                    if not streams and self.last_stream_status != "offline":
+                    if not latest and self.last_stream_status != "offline":
                         logger.info("Stream offline, waiting...")
                         self.last_stream_status = "offline"
+                        streams = latest
                         break
 
     def start_new_ffmpeg(self, stream, quality):
         new_ffmpeg = start_ffmpeg(stream, quality)
         if not new_ffmpeg:
-            logger.error(f"Failed to start FFmpeg for {quality}, retrying in 10s")
-            time.sleep(10)
+            if self.current_ffmpeg and self.current_ffmpeg.poll() is not None:
+                self.current_ffmpeg = None
+            self.back_off("Failed to start FFmpeg for %s", quality)
+            self.exit_event.set()
             return
-        if self.current_ffmpeg and self.current_ffmpeg != new_ffmpeg:
-            logger.info(f"Stopping previous FFmpeg PID {self.current_ffmpeg.pid}")
-            self.current_ffmpeg.terminate()
-            try:
-                self.current_ffmpeg.wait(timeout=10)
-            except:
-                self.current_ffmpeg.kill()
+        old_ffmpeg = self.current_ffmpeg
         self.current_ffmpeg = new_ffmpeg
+        if old_ffmpeg and old_ffmpeg != new_ffmpeg:
+            logger.info("Stopping previous FFmpeg PID %d", old_ffmpeg.pid)
+            # Tear down in the background so the relay lock is not held while it exits
+            threading.Thread(target=stop_ffmpeg, args=(old_ffmpeg,), daemon=True).start()
         self.current_quality = quality
         self.start_time = time.time()
         self.stream_obj = stream
+        # Sets exit_event as soon as this process exits
+        threading.Thread(target=self.watch_ffmpeg, args=(new_ffmpeg,), daemon=True).start()
+
+    def back_off(self, msg, *args):
+        self.start_failures += 1
+        delay = backoff_delay(self.start_failures)
+        logger.error(msg + ", retrying in %.0fs", *args, delay)
+        time.sleep(delay)
+
+    def watch_ffmpeg(self, proc):
+        proc.wait()
+        if proc is self.current_ffmpeg:
+            self.exit_event.set()
 
 # --- Main ---
 if __name__ == "__main__":
@@ -300,5 +419,4 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         logger.info("Exiting...")
     if relay.current_ffmpeg:
-        relay.current_ffmpeg.terminate()
-        relay.current_ffmpeg.wait()
+        stop_ffmpeg(relay.current_ffmpeg)